@@ -1,16 +1,40 @@
 import cv2
 import threading
 import time
-import json
 import os
+import shutil
+import subprocess
 import sys
 import numpy as np
+import orjson
 from flask import Flask, render_template, Response, request
 from flask_cors import CORS
+from stream_utils import MJPEG_PART_FOOTER, MJPEG_PART_HEADER, draw_text, encode_jpeg, json_response
 
 # --- Configuration ---
-MOTION_THRESHOLD = 1000  # Sensitivity for motion detection. Higher value means less sensitive.
+MOTION_THRESHOLD_PIXELS = 400  # Sensitivity for motion detection (changed pixels on the downscaled frame). Higher value means less sensitive.
+MOTION_PIXEL_DELTA = 30  # Minimum brightness change for a pixel to count as changed
+MOTION_FRAME_SIZE = (320, 240)  # (width, height) frames are downscaled to before motion detection
+DILATE_KERNEL = cv2.getStructuringElement(cv2.MORPH_RECT, (5, 5))  # Same result as two 3x3 iterations in one pass
+MOTION_ROI = os.getenv("MOTION_ROI", "")  # "y0,y1,x0,x1" region of the camera frame watched for motion (empty: whole frame)
+MOTION_BACKEND = os.getenv("MOTION_BACKEND", "opencv").lower()  # "opencv" or "numba" (fused kernel, needs numba installed)
 CAMERA_INDEX = int(os.getenv("CAMERA_INDEX", "0"))  # Camera device index (e.g. 0:/dev/video0, 2:/dev/video2)
+JPEG_QUALITY = int(os.getenv("JPEG_QUALITY", "75"))  # Quality of the streamed JPEG frames (1-100). Lower is faster and smaller.
+STREAM_FORMAT = os.getenv("STREAM_FORMAT", "mjpeg").lower()  # "mjpeg" or "h264" (H.264 needs ffmpeg on PATH)
+FFMPEG_PATH = shutil.which("ffmpeg")
+STREAM_FPS = float(os.getenv("STREAM_FPS", "30"))  # Maximum frame rate published to the video clients
+MOTION_FPS = float(os.getenv("MOTION_FPS", "10"))  # Rate at which motion detection samples frames in RED mode
+PIN_THREADS = os.getenv("PIN_THREADS", "1") == "1"  # Pin capture and encoder threads to separate CPUs (Linux only)
+
+if not 1 <= JPEG_QUALITY <= 100:
+    JPEG_QUALITY = min(max(JPEG_QUALITY, 1), 100)
+    print(f"Invalid JPEG_QUALITY '{os.getenv('JPEG_QUALITY')}'. Expected 1-100; using {JPEG_QUALITY}.")
+if not STREAM_FPS > 0:
+    print(f"Invalid STREAM_FPS '{os.getenv('STREAM_FPS')}'. Expected a value above 0; using 30.")
+    STREAM_FPS = 30.0
+if not MOTION_FPS > 0:
+    print(f"Invalid MOTION_FPS '{os.getenv('MOTION_FPS')}'. Expected a value above 0; using 10.")
+    MOTION_FPS = 10.0
 
 BACKEND_NAME = {
     None: "DEFAULT",
@@ -20,14 +44,38 @@ BACKEND_NAME = {
     cv2.CAP_V4L2: "CAP_V4L2",
 }
 
+# The frames are small; OpenCV's own worker threads would only fight the pinned threads below
+cv2.setNumThreads(1)
+
+# CPUs this process may run on, read once before any thread narrows its own affinity
+AVAILABLE_CPUS = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+
 # --- Game State Variables ---
 game_state = {
     "mode": "IDLE",  # IDLE, GREEN, RED, GAME_OVER
     "penalty_flash": False,
-    "last_penalty_time": 0,
+    "last_penalty_time": 0,  # time.monotonic() of the last penalty
 }
 state_lock = threading.Lock()
 
+# Serialised game_state, refreshed on every mutation so /api/gamestate never has to serialise.
+# state_json_flash_cleared is the same state with penalty_flash reset, swapped in once it was sent.
+state_json_bytes = b""
+state_json_flash_cleared = b""
+
+
+def _publish_state():
+    """Re-serialise game_state after a mutation. Must be called with state_lock held."""
+    global state_json_bytes, state_json_flash_cleared
+    state_json_bytes = orjson.dumps(game_state)
+    if game_state["penalty_flash"]:
+        state_json_flash_cleared = orjson.dumps({**game_state, "penalty_flash": False})
+    else:
+        state_json_flash_cleared = state_json_bytes
+
+
+_publish_state()
+
 # --- Flask App Initialization ---
 app = Flask(__name__)
 CORS(app)
@@ -80,91 +128,452 @@ def open_camera():
     return None
 
 
-def generate_frames():
+if MOTION_BACKEND == "numba":
+    from numba import njit
+
+    # Single-threaded on purpose: the capture thread is pinned to one CPU and
+    # Numba's worker threads would inherit that affinity
+    @njit(cache=True)
+    def _motion_mask(prev_gray, gray, prev_mask, mask, thresh, pixel_delta):
+        """
+        Fused three-frame difference: writes |gray - prev_gray| > pixel_delta into mask and
+        its intersection with prev_mask into thresh, in a single pass over the image.
+        """
+        height, width = gray.shape
+        for i in range(height):
+            for j in range(width):
+                changed = abs(np.int16(gray[i, j]) - np.int16(prev_gray[i, j])) > pixel_delta
+                mask[i, j] = 255 if changed else 0
+                thresh[i, j] = 255 if changed and prev_mask[i, j] != 0 else 0
+
+
+def enable_mjpeg_passthrough(camera):
     """
-    Captures frames from the camera, performs motion detection if mode is RED,
-    and yields frames as a multipart HTTP response.
+    Asks a V4L2 camera for MJPEG frames and turns off OpenCV's conversion, so that
+    retrieve() returns the camera's JPEG bytes and decoding only happens on demand.
+    Returns True if the camera accepted both settings.
     """
-    global game_state
-    print(f"Initializing camera with index {CAMERA_INDEX}...")
-    camera = open_camera()
+    if camera.getBackendName() != "V4L2":
+        return False
+    fourcc = cv2.VideoWriter_fourcc(*'MJPG')
+    if not camera.set(cv2.CAP_PROP_FOURCC, fourcc) or int(camera.get(cv2.CAP_PROP_FOURCC)) != fourcc:
+        return False
+    return camera.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+
+
+def parse_roi(value):
+    """Parses a "y0,y1,x0,x1" string into a (rows, cols) slice pair, or None for the whole frame."""
+    if not value:
+        return None
     try:
+        y0, y1, x0, x1 = (int(v) for v in value.split(","))
+    except ValueError:
+        print(f"Invalid MOTION_ROI '{value}'. Expected 'y0,y1,x0,x1'; watching the whole frame.")
+        return None
+    if not (0 <= y0 < y1 and 0 <= x0 < x1):
+        print(f"Invalid MOTION_ROI '{value}'. Expected 0 <= y0 < y1 and 0 <= x0 < x1; watching the whole frame.")
+        return None
+    return (slice(y0, y1), slice(x0, x1))
+
+
+MOTION_ROI_SLICES = parse_roi(MOTION_ROI)
+
+
+def pin_current_thread(cpu_slot):
+    """Pins the calling thread to one of the available CPUs (no-op unless Linux with 2+ CPUs)."""
+    if not PIN_THREADS or len(AVAILABLE_CPUS) < 2:
+        return
+    os.sched_setaffinity(0, {AVAILABLE_CPUS[cpu_slot % len(AVAILABLE_CPUS)]})
+
+
+class CameraWorker:
+    """
+    Owns the camera and runs capture + motion detection and JPEG encoding once,
+    in two background threads pinned to different CPUs. Every /video_feed client
+    shares the latest frame instead of running its own copy of the pipeline.
+    """
+
+    def __init__(self):
+        # latest_frame is the annotated BGR frame (used by the H.264 stream, None when the camera JPEG
+        # was passed through undecoded), latest_jpeg its MJPEG encoding
+        self.cond = threading.Condition()
+        self.latest_jpeg = b""
+        self.latest_frame = None
+        self.frame_id = 0
+        self._pending = None  # (frame, jpeg) handed from the capture thread to the encoder thread
+        self.clients = 0
+        self.frame_clients = 0  # Clients that need decoded frames (H.264 stream)
+        self.running = False
+        self._thread = None
+        self._roi_warned = False  # The "MOTION_ROI outside the frame" warning is printed only once
+
+    def attach(self, needs_frames=False):
+        """Register a streaming client, starting the capture thread if needed."""
+        with self.cond:
+            self.clients += 1
+            if needs_frames:
+                self.frame_clients += 1
+            if self.running:
+                return
+            self.running = True
+            # Frames from a previous session must not be shown to (or size the encoder of) new clients
+            self.latest_jpeg = b""
+            self.latest_frame = None
+            previous_thread = self._thread
+            self._thread = threading.Thread(target=self._run, args=(previous_thread,), daemon=True)
+            self._thread.start()
+
+    def detach(self, needs_frames=False):
+        """Unregister a streaming client. The capture thread stops once none are left."""
+        with self.cond:
+            self.clients -= 1
+            if needs_frames:
+                self.frame_clients -= 1
+
+    def _should_stop(self):
+        with self.cond:
+            # A newer capture thread has taken over after this one's encoder stopped
+            if self._thread is not threading.current_thread():
+                return True
+            # running is also cleared by an encoder thread that exited unexpectedly
+            if self.clients <= 0 or not self.running:
+                self.running = False
+                return True
+            return False
+
+    def _publish(self, frame, jpeg=None):
+        """Hands a frame to the encoder thread, replacing one it has not picked up yet."""
+        with self.cond:
+            self._pending = (frame, jpeg)
+            self.cond.notify_all()
+
+    def _encode_loop(self, stop_event):
+        pin_current_thread(1)
+        try:
+            while True:
+                with self.cond:
+                    self.cond.wait_for(lambda: self._pending is not None or stop_event.is_set())
+                    if stop_event.is_set():
+                        return
+                    frame, jpeg = self._pending
+                    self._pending = None
+
+                if jpeg is None:
+                    try:
+                        jpeg = encode_jpeg(frame, JPEG_QUALITY)
+                    except ValueError as e:
+                        print(f"Failed to encode frame: {e}")
+                        continue
+
+                with self.cond:
+                    self.latest_jpeg = jpeg
+                    self.latest_frame = frame
+                    self.frame_id += 1
+                    self.cond.notify_all()
+        finally:
+            with self.cond:
+                if not stop_event.is_set():
+                    # Without an encoder no frame is ever published: stop the capture loop
+                    # and wake the clients so they do not wait forever
+                    self.running = False
+                self.cond.notify_all()
+
+    def _allocate_buffers(self, size):
+        """
+        Allocates the motion detection buffers of the given (width, height) once so the
+        capture loop only passes them as dst= arguments. Three-frame differencing keeps
+        F(k-1) in prev_gray and the binarised |F(k-1) - F(k-2)| in prev_mask from the
+        previous iteration.
+        """
+        width, height = size
+        self.small = np.empty((height, width, 3), np.uint8)
+        self.gray = np.empty((height, width), np.uint8)
+        self.prev_gray = np.empty((height, width), np.uint8)
+        self.mask = np.empty((height, width), np.uint8)
+        self.prev_mask = np.empty((height, width), np.uint8)
+        self.thresh = np.empty((height, width), np.uint8)
+        # Frames of RED history available for three-frame differencing (capped at 3)
+        self.motion_history = 0
+
+    def _detect_motion(self, frame):
+        """
+        Runs three-frame differencing on a downscaled grayscale copy of the frame's
+        MOTION_ROI region. Returns False until enough history has been collected.
+        """
+        # Numpy view of the watched region, no copy
+        region = frame[MOTION_ROI_SLICES] if MOTION_ROI_SLICES is not None else frame
+        region_height, region_width = region.shape[:2]
+        if region_height == 0 or region_width == 0:
+            if not self._roi_warned:
+                print(f"MOTION_ROI '{MOTION_ROI}' lies outside the {frame.shape[1]}x{frame.shape[0]} frame; motion detection is disabled.")
+                self._roi_warned = True
+            return False
+
+        # Downscale the region by the same factor as a full frame scaled to MOTION_FRAME_SIZE
+        frame_height, frame_width = frame.shape[:2]
+        size = (
+            max(1, round(region_width * MOTION_FRAME_SIZE[0] / frame_width)),
+            max(1, round(region_height * MOTION_FRAME_SIZE[1] / frame_height)),
+        )
+        if self.small.shape[1::-1] != size:
+            self._allocate_buffers(size)
+
+        # Motion detection only needs a coarse view, so work on a downscaled copy
+        cv2.resize(region, size, dst=self.small, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self.small, cv2.COLOR_BGR2GRAY, dst=self.gray)
+        self.motion_history = min(self.motion_history + 1, 3)
+
+        if self.motion_history == 1:
+            self.gray, self.prev_gray = self.prev_gray, self.gray
+            return False
+
+        # Only pixels that changed in both consecutive differences count as motion,
+        # which suppresses sensor noise without an expensive blur
+        if MOTION_BACKEND == "numba":
+            _motion_mask(self.prev_gray, self.gray, self.prev_mask, self.mask, self.thresh, MOTION_PIXEL_DELTA)
+        else:
+            cv2.absdiff(self.prev_gray, self.gray, dst=self.mask)
+            cv2.threshold(self.mask, MOTION_PIXEL_DELTA, 255, cv2.THRESH_BINARY, dst=self.mask)
+            cv2.bitwise_and(self.mask, self.prev_mask, dst=self.thresh)
+        cv2.dilate(self.thresh, DILATE_KERNEL, dst=self.thresh)
+        # countNonZero is already a vectorised byte count; packing the mask into a bitmap
+        # for popcount costs more than it saves at this resolution
+        count = cv2.countNonZero(self.thresh)
+
+        # Rotate the buffers without allocating: the current frame becomes F(k-1)
+        self.gray, self.prev_gray = self.prev_gray, self.gray
+        self.mask, self.prev_mask = self.prev_mask, self.mask
+
+        # With only two frames prev_mask does not hold a difference yet
+        return self.motion_history == 3 and count > MOTION_THRESHOLD_PIXELS
+
+    def _run(self, previous_thread):
+        # Make sure a previous capture thread has released the device before reopening it
+        if previous_thread is not None:
+            previous_thread.join()
+
+        stop_event = threading.Event()
+        encoder_thread = threading.Thread(target=self._encode_loop, args=(stop_event,), daemon=True)
+        encoder_thread.start()
+        pin_current_thread(0)
+
+        print(f"Initializing camera with index {CAMERA_INDEX}...")
+        camera = open_camera()
+        try:
+            self._capture_loop(camera)
+        finally:
+            stop_event.set()
+            with self.cond:
+                if self._thread is threading.current_thread():
+                    self.running = False
+                self._pending = None
+                self.cond.notify_all()
+            encoder_thread.join()
+            if camera is not None:
+                camera.release()
+            print("Camera released.")
+
+    def _capture_loop(self, camera):
+        """
+        Captures frames from the camera, performs motion detection if mode is RED,
+        and publishes the encoded frames until no client is left.
+        """
         camera_opened = camera is not None and camera.isOpened()
         if not camera_opened:
             print(f"Warning: Could not start camera index {CAMERA_INDEX}. Displaying a black screen instead.")
 
-        previous_frame = None
+        passthrough = camera_opened and enable_mjpeg_passthrough(camera)
+        if passthrough:
+            print("Camera delivers MJPEG; frames are only decoded when needed.")
 
-        while True:
+        self._allocate_buffers(MOTION_FRAME_SIZE)
+        frame_interval = 1.0 / STREAM_FPS
+        motion_interval = 1.0 / MOTION_FPS
+        next_frame_due = 0.0
+        next_motion_due = 0.0
+
+        while not self._should_stop():
             if not camera_opened:
                 # Fallback black screen
                 frame = np.zeros((480, 640, 3), dtype=np.uint8)
-                cv2.putText(frame, "Camera not available", (50, 240), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
-                (flag, encodedImage) = cv2.imencode(".jpg", frame)
-                if flag:
-                    yield(b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + 
-                          bytearray(encodedImage) + b'\r\n')
+                draw_text(frame, "Camera not available", (50, 240), 1, (255, 255, 255), 2)
+                self._publish(frame)
                 time.sleep(0.1)
                 continue
 
-            success, frame = camera.read()
-            if not success:
+            if not camera.grab():
                 break
 
-            with state_lock:
-                current_mode = game_state["mode"]
+            # One monotonic timestamp per iteration, reused for pacing and the penalty window
+            now = time.monotonic()
 
-            if current_mode == "RED":
-                gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-                gray = cv2.GaussianBlur(gray, (21, 21), 0)
+            # Drop frames above the target rate before they are decoded
+            if now < next_frame_due:
+                continue
+            next_frame_due = max(next_frame_due + frame_interval, now)
 
-                if previous_frame is None:
-                    previous_frame = gray
-                    time.sleep(0.05)
-                    continue
+            # One snapshot per frame; the motion pipeline below runs without the lock
+            with state_lock:
+                snapshot = game_state.copy()
+            current_mode = snapshot["mode"]
+            last_penalty = snapshot.get("last_penalty_time", 0)
+
+            # Motion detection samples at its own (lower) rate, independent of the stream
+            run_motion = current_mode == "RED" and now >= next_motion_due
+            if run_motion:
+                next_motion_due = max(next_motion_due + motion_interval, now)
+            elif current_mode != "RED":
+                self.motion_history = 0
+
+            success, frame = camera.retrieve()
+            if not success:
+                break
 
-                frame_delta = cv2.absdiff(previous_frame, gray)
-                thresh = cv2.threshold(frame_delta, 30, 255, cv2.THRESH_BINARY)[1]
-                thresh = cv2.dilate(thresh, None, iterations=2)
-                contours, _ = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            if passthrough:
+                # The camera's JPEG can be served as-is unless something needs pixels
+                needs_pixels = (
+                    run_motion
+                    or now - last_penalty < 1.0
+                    or self.frame_clients > 0
+                )
+                if not needs_pixels:
+                    self._publish(None, jpeg=frame.tobytes())
+                    continue
+                frame = cv2.imdecode(frame, cv2.IMREAD_COLOR)
+                if frame is None:
+                    continue
 
-                motion_detected = any(cv2.contourArea(c) > MOTION_THRESHOLD for c in contours)
+            if run_motion:
+                motion_detected = self._detect_motion(frame)
 
-                if motion_detected:
+                if motion_detected and now - last_penalty > 1.0 and not snapshot["penalty_flash"]:
                     with state_lock:
-                        current_time = time.time()
-                        if current_time - game_state.get("last_penalty_time", 0) > 1.0:
+                        # Re-check under the lock in case an API call changed the state meanwhile
+                        if now - game_state.get("last_penalty_time", 0) > 1.0:
                             if not game_state["penalty_flash"]:
                                 game_state["penalty_flash"] = True
-                                game_state["last_penalty_time"] = current_time
-                
-                previous_frame = gray
-            else:
-                previous_frame = None
+                                game_state["last_penalty_time"] = now
+                                _publish_state()
+                        last_penalty = game_state.get("last_penalty_time", 0)
+
+            if now - last_penalty < 1.0:
+                draw_text(frame, "MOTION DETECTED!", (120, 240), 1.5, (0, 0, 255), 3)
+
+            self._publish(frame)
 
-            with state_lock:
-                display_mode = game_state["mode"]
-                last_penalty = game_state.get("last_penalty_time", 0)
 
-            if time.time() - last_penalty < 1.0:
-                cv2.putText(frame, "MOTION DETECTED!", (120, 240), cv2.FONT_HERSHEY_SIMPLEX, 1.5, (0, 0, 255), 3)
+camera_worker = CameraWorker()
 
-            (flag, encodedImage) = cv2.imencode(".jpg", frame)
-            if not flag:
+
+def generate_frames():
+    """
+    Yields the frames published by the shared camera worker as a multipart
+    HTTP response. Frames produced while this client was busy are skipped.
+    """
+    camera_worker.attach()
+    try:
+        # Start at the current frame so the client only receives frames published after it joined
+        with camera_worker.cond:
+            last_seen = camera_worker.frame_id
+        while True:
+            with camera_worker.cond:
+                camera_worker.cond.wait_for(
+                    lambda: camera_worker.frame_id != last_seen or not camera_worker.running
+                )
+                if camera_worker.frame_id == last_seen:
+                    break
+                last_seen = camera_worker.frame_id
+                data = camera_worker.latest_jpeg
+
+            yield from (MJPEG_PART_HEADER, data, MJPEG_PART_FOOTER)
+    finally:
+        camera_worker.detach()
+
+def _feed_encoder(encoder, stop_event, frame_size, last_seen):
+    """Writes every new worker frame into the ffmpeg encoder's stdin."""
+    try:
+        while not stop_event.is_set():
+            with camera_worker.cond:
+                camera_worker.cond.wait_for(
+                    lambda: camera_worker.frame_id != last_seen or not camera_worker.running,
+                    timeout=1.0,
+                )
+                if not camera_worker.running:
+                    break
+                if camera_worker.frame_id == last_seen:
+                    continue
+                last_seen = camera_worker.frame_id
+                frame = camera_worker.latest_frame
+
+            if frame is None:
                 continue
+            if (frame.shape[1], frame.shape[0]) != frame_size:
+                frame = cv2.resize(frame, frame_size)
+            encoder.stdin.write(memoryview(np.ascontiguousarray(frame)))
+    except (BrokenPipeError, ValueError, OSError):
+        pass
+    finally:
+        try:
+            encoder.stdin.close()
+        except OSError:
+            pass
+
+
+def generate_h264():
+    """
+    Streams the shared camera worker frames as fragmented MP4 (H.264) produced by an
+    ffmpeg subprocess. Unlike MJPEG, static scenes compress to almost nothing.
+    """
+    camera_worker.attach(needs_frames=True)
+    encoder = None
+    stop_event = threading.Event()
+    try:
+        with camera_worker.cond:
+            camera_worker.cond.wait_for(
+                lambda: camera_worker.latest_frame is not None or not camera_worker.running
+            )
+            if camera_worker.latest_frame is None:
+                return
+            height, width = camera_worker.latest_frame.shape[:2]
+            last_seen = camera_worker.frame_id - 1
+
+        encoder = subprocess.Popen(
+            [
+                FFMPEG_PATH, "-loglevel", "error",
+                "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}",
+                "-use_wallclock_as_timestamps", "1", "-i", "-",
+                "-c:v", "libx264", "-preset", "ultrafast", "-tune", "zerolatency",
+                "-pix_fmt", "yuv420p", "-g", "30",
+                "-f", "mp4", "-movflags", "frag_keyframe+empty_moov+default_base_moof",
+                "pipe:1",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        feeder = threading.Thread(
+            target=_feed_encoder, args=(encoder, stop_event, (width, height), last_seen), daemon=True
+        )
+        feeder.start()
 
-            yield(b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + 
-                  bytearray(encodedImage) + b'\r\n')
+        while True:
+            chunk = encoder.stdout.read1(65536)
+            if not chunk:
+                break
+            yield chunk
     finally:
-        if camera is not None:
-            camera.release()
-        print("Camera released.")
+        stop_event.set()
+        if encoder is not None:
+            encoder.kill()
+            encoder.wait()
+        camera_worker.detach(needs_frames=True)
+
 
 # --- Flask Routes ---
 @app.route('/')
 def index():
     """Main page."""
-    return render_template('index.html')
+    use_h264 = STREAM_FORMAT == "h264" and FFMPEG_PATH is not None
+    return render_template('index.html', stream_format="h264" if use_h264 else "mjpeg")
 
 @app.route('/video_feed')
 def video_feed():
@@ -172,14 +581,23 @@ def video_feed():
     return Response(generate_frames(),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
+@app.route('/video_feed_h264')
+def video_feed_h264():
+    """H.264 (fragmented MP4) video streaming route. /video_feed stays available as the MJPEG fallback."""
+    if FFMPEG_PATH is None:
+        return json_response({"status": "error", "message": "ffmpeg is not installed"}, 503)
+    return Response(generate_h264(), mimetype='video/mp4')
+
 @app.route('/api/gamestate')
 def get_gamestate():
     """API to get current game state."""
+    global state_json_bytes
     with state_lock:
-        state_to_send = game_state.copy()
+        data = state_json_bytes
         if game_state["penalty_flash"]:
             game_state["penalty_flash"] = False
-    return json.dumps(state_to_send)
+            state_json_bytes = state_json_flash_cleared
+    return Response(data, mimetype='application/json')
 
 @app.route('/api/start', methods=['POST'])
 def start_game():
@@ -188,21 +606,25 @@ def start_game():
         game_state["mode"] = "GREEN"
         game_state["penalty_flash"] = False
         game_state["last_penalty_time"] = 0
-    return json.dumps(game_state)
+        _publish_state()
+        data = state_json_bytes
+    return Response(data, mimetype='application/json')
 
 @app.route('/api/end', methods=['POST'])
 def end_game():
     """API to end the game (sets mode to GAME_OVER)."""
     with state_lock:
         game_state["mode"] = "GAME_OVER"
-    return json.dumps(game_state)
+        _publish_state()
+        data = state_json_bytes
+    return Response(data, mimetype='application/json')
 
 @app.route('/api/setmode', methods=['POST'])
 def set_mode():
     """API for the client to set the game mode (e.g., GREEN, RED)."""
     data = request.get_json(silent=True)
     if not data:
-        return json.dumps({"status": "error", "message": "Invalid JSON"}), 400
+        return json_response({"status": "error", "message": "Invalid JSON"}, 400)
         
     new_mode = data.get("mode")
     valid_modes = {"GREEN", "RED", "IDLE"}
@@ -213,8 +635,9 @@ def set_mode():
             if new_mode == "IDLE":
                 game_state["penalty_flash"] = False
                 game_state["last_penalty_time"] = 0
-        return json.dumps({"status": "success", "new_mode": new_mode})
-    return json.dumps({"status": "error", "message": "Invalid mode"}), 400
+            _publish_state()
+        return json_response({"status": "success", "new_mode": new_mode})
+    return json_response({"status": "error", "message": "Invalid mode"}, 400)
 
 # --- Main Execution ---
 if __name__ == '__main__':
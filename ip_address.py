@@ -2,17 +2,26 @@
 import cv2
 import threading
 import time
-import json
+import math
+import os
 import numpy as np
 from flask import Flask, render_template, Response
 from flask_cors import CORS 
+from stream_utils import MJPEG_PART_FOOTER, MJPEG_PART_HEADER, draw_text, encode_jpeg, json_response
+
+DILATE_KERNEL = cv2.getStructuringElement(cv2.MORPH_RECT, (5, 5))  # Same result as two 3x3 iterations in one pass
+JPEG_QUALITY = int(os.getenv("JPEG_QUALITY", "75"))  # Quality of the streamed JPEG frames (1-100). Lower is faster and smaller.
+if not 1 <= JPEG_QUALITY <= 100:
+    JPEG_QUALITY = min(max(JPEG_QUALITY, 1), 100)
+    print(f"Invalid JPEG_QUALITY '{os.getenv('JPEG_QUALITY')}'. Expected 1-100; using {JPEG_QUALITY}.")
+
 # --- Game State Variables ---
 game_state = {
     "mode": "GREEN",
     "total_time": 180,
     "interval_timer": 20,
     "penalty_flash": False,
-    "last_penalty_time": 1, # To manage penalty interval
+    "last_penalty_time": 1, # To manage penalty interval (time.monotonic())
 }
 state_lock = threading.Lock()
 
@@ -20,38 +29,101 @@ state_lock = threading.Lock()
 # --- Flask App Initialization ---
 app = Flask(__name__)
 CORS(app)
-# --- Background Thread for Game Logic ---
-def game_logic_thread():
+# --- Event-driven Game Logic ---
+INTERVAL_DURATION = 20  # 20 seconds for both GREEN and RED
+
+# total_time / interval_timer in game_state hold the values at the monotonic "anchor" times below.
+# The remaining time is derived from them on demand, and timers only fire on actual transitions.
+game_clock = {
+    "total_anchor": time.monotonic(),
+    "interval_anchor": time.monotonic(),
+    "generation": 0,  # Bumped on every reschedule so stale timer callbacks do nothing
+}
+game_timers = []
+
+
+def _current_state():
     """
-    Manages the game state (GREEN/RED/GAME_OVER) and timers in a background thread.
+    Returns a copy of game_state with the timers counted down to now.
+    Must be called with state_lock held.
     """
-    global game_state
-    interval_duration = 20  # 20 seconds for both GREEN and RED
+    state = game_state.copy()
+    if state["mode"] != "GAME_OVER":
+        now = time.monotonic()
+        state["total_time"] = max(0, math.ceil(state["total_time"] - (now - game_clock["total_anchor"])))
+        state["interval_timer"] = max(0, math.ceil(state["interval_timer"] - (now - game_clock["interval_anchor"])))
+    return state
 
-    while True:
-        time.sleep(1)
-        with state_lock:
-            # If game is over, do nothing
-            if game_state["mode"] == "GAME_OVER":
-                continue
 
-            # Decrement timers
-            game_state["total_time"] -= 1
-            game_state["interval_timer"] -= 1
+def _reset_clock():
+    """Anchors both timers to now. Must be called with state_lock held."""
+    now = time.monotonic()
+    game_clock["total_anchor"] = now
+    game_clock["interval_anchor"] = now
 
-            # Check for game over
-            if game_state["total_time"] <= 0:
-                game_state["mode"] = "GAME_OVER"
-                game_state["total_time"] = 0
-                continue
 
-            # Check for state transition
-            if game_state["interval_timer"] <= 0:
-                if game_state["mode"] == "GREEN":
-                    game_state["mode"] = "RED"
-                elif game_state["mode"] == "RED":
-                    game_state["mode"] = "GREEN"
-                game_state["interval_timer"] = interval_duration
+def _freeze_clock():
+    """Stores the counted-down timers in game_state, e.g. before GAME_OVER. Must be called with state_lock held."""
+    state = _current_state()
+    game_state["total_time"] = state["total_time"]
+    game_state["interval_timer"] = state["interval_timer"]
+
+
+def _schedule_transitions():
+    """
+    (Re)arms the timers for the next GREEN/RED flip and for the game over.
+    Must be called with state_lock held.
+    """
+    for timer in game_timers:
+        timer.cancel()
+    game_timers.clear()
+    game_clock["generation"] += 1
+
+    if game_state["mode"] == "GAME_OVER":
+        return
+
+    now = time.monotonic()
+    total_left = game_state["total_time"] - (now - game_clock["total_anchor"])
+    interval_left = game_state["interval_timer"] - (now - game_clock["interval_anchor"])
+    for delay, callback in ((total_left, _on_game_over), (interval_left, _on_interval_end)):
+        timer = threading.Timer(max(0, delay), callback, args=(game_clock["generation"],))
+        timer.daemon = True
+        timer.start()
+        game_timers.append(timer)
+
+
+def _on_interval_end(generation):
+    """Switches between GREEN and RED when the interval runs out."""
+    with state_lock:
+        if generation != game_clock["generation"] or game_state["mode"] == "GAME_OVER":
+            return
+        if game_state["mode"] == "GREEN":
+            game_state["mode"] = "RED"
+        elif game_state["mode"] == "RED":
+            game_state["mode"] = "GREEN"
+        game_state["interval_timer"] = INTERVAL_DURATION
+        game_clock["interval_anchor"] = time.monotonic()
+        _schedule_transitions()
+
+
+def _on_game_over(generation):
+    """Ends the game when the total time runs out."""
+    with state_lock:
+        if generation != game_clock["generation"] or game_state["mode"] == "GAME_OVER":
+            return
+        _freeze_clock()
+        game_state["mode"] = "GAME_OVER"
+        game_state["total_time"] = 0
+        _schedule_transitions()
+
+
+def start_game_logic():
+    """
+    Starts the game (GREEN/RED/GAME_OVER) timers for the current game_state.
+    """
+    with state_lock:
+        _reset_clock()
+        _schedule_transitions()
 
 
 # --- Video Streaming and Motion Detection ---
@@ -67,18 +139,20 @@ def generate_frames():
     if not camera_opened:
         print("Warning: Could not start camera. Displaying a black screen instead.")
 
-    previous_frame = None
-    motion_threshold = 1000
+    # Double-buffered grayscale frames: gray_buffers[index] receives the current frame while
+    # gray_buffers[index ^ 1] still holds the previous one, so nothing is allocated per frame
+    gray_buffers = None
+    frame_delta = None
+    index = 0
+    has_previous = False
+    motion_threshold_pixels = 1500
 
     while True:
         if not camera_opened:
             # Create a black frame with an error message if camera is not available
             frame = np.zeros((480, 640, 3), dtype=np.uint8)
-            cv2.putText(frame, "Camera not available", (50, 240), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
-            (flag, encodedImage) = cv2.imencode(".jpg", frame)
-            if flag:
-                yield(b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + 
-                      bytearray(encodedImage) + b'\r\n')
+            draw_text(frame, "Camera not available", (50, 240), 1, (255, 255, 255), 2)
+            yield from (MJPEG_PART_HEADER, encode_jpeg(frame, JPEG_QUALITY), MJPEG_PART_FOOTER)
             time.sleep(0.1) # Limit frame rate
             continue
 
@@ -86,56 +160,64 @@ def generate_frames():
         if not success:
             break
 
+        # One snapshot per frame; only a penalty takes the lock again
         with state_lock:
-            current_mode = game_state["mode"]
+            display_state = _current_state()
+        current_mode = display_state["mode"]
 
         if current_mode == "RED":
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            gray = cv2.GaussianBlur(gray, (21, 21), 0)
+            if gray_buffers is None or gray_buffers[0].shape != frame.shape[:2]:
+                gray_buffers = [np.empty(frame.shape[:2], np.uint8), np.empty(frame.shape[:2], np.uint8)]
+                frame_delta = np.empty(frame.shape[:2], np.uint8)
+                has_previous = False
+
+            gray = gray_buffers[index]
+            cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=gray)
+            cv2.GaussianBlur(gray, (21, 21), 0, dst=gray)
 
-            if previous_frame is None:
-                previous_frame = gray
+            if not has_previous:
+                has_previous = True
+                index ^= 1
                 time.sleep(0.1)
                 continue
 
-            frame_delta = cv2.absdiff(previous_frame, gray)
-            thresh = cv2.threshold(frame_delta, 30, 255, cv2.THRESH_BINARY)[1]
-            thresh = cv2.dilate(thresh, None, iterations=2)
+            cv2.absdiff(gray_buffers[index ^ 1], gray, dst=frame_delta)
+            cv2.threshold(frame_delta, 30, 255, cv2.THRESH_BINARY, dst=frame_delta)
+            thresh = cv2.dilate(frame_delta, DILATE_KERNEL, dst=frame_delta)
 
-            contours, _ = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            motion_detected = cv2.countNonZero(thresh) > motion_threshold_pixels
 
-            motion_detected = any(cv2.contourArea(c) > motion_threshold for c in contours)
-
-            if motion_detected:
+            # Monotonic, so wall-clock adjustments cannot re-trigger a penalty
+            current_time = time.monotonic()
+            if motion_detected and current_time - display_state["last_penalty_time"] > 1.0:
                 with state_lock:
-                    current_time = time.time()
+                    # Re-check under the lock in case an API call changed the state meanwhile
                     if current_time - game_state["last_penalty_time"] > 1.0:
-                        if game_state["total_time"] > 0:
-                            game_state["total_time"] = max(0, game_state["total_time"] - 5)
+                        if _current_state()["total_time"] > 0:
+                            game_state["total_time"] -= 5
                             game_state["penalty_flash"] = True
                             game_state["last_penalty_time"] = current_time
-            
-            previous_frame = gray
+                            # The penalty brings the game over closer
+                            _schedule_transitions()
+                            display_state = _current_state()
+
+            # The current frame becomes the previous one for the next iteration
+            index ^= 1
         else:
-            previous_frame = None
+            has_previous = False
 
         # Draw status on the frame
-        with state_lock:
-            display_mode = game_state["mode"]
-            display_total_time = game_state["total_time"]
-            display_interval_timer = game_state["interval_timer"]
+        display_mode = display_state["mode"]
+        display_total_time = display_state["total_time"]
+        display_interval_timer = display_state["interval_timer"]
 
         color = {"GREEN": (0, 255, 0), "RED": (0, 0, 255), "GAME_OVER": (0, 255, 255)}.get(display_mode, (255, 255, 255))
-        cv2.putText(frame, f"MODE: {display_mode}", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, color, 2)
-        cv2.putText(frame, f"TOTAL TIME: {display_total_time}", (10, 70), cv2.FONT_HERSHEY_SIMPLEX, 1, color, 2)
-        cv2.putText(frame, f"INTERVAL: {display_interval_timer}", (10, 110), cv2.FONT_HERSHEY_SIMPLEX, 1, color, 2)
+        draw_text(frame, f"MODE: {display_mode}", (10, 30), 1, color, 2)
+        draw_text(frame, f"TOTAL TIME: {display_total_time}", (10, 70), 1, color, 2)
+        draw_text(frame, f"INTERVAL: {display_interval_timer}", (10, 110), 1, color, 2)
 
-        (flag, encodedImage) = cv2.imencode(".jpg", frame)
-        if not flag:
-            continue
+        yield from (MJPEG_PART_HEADER, encode_jpeg(frame, JPEG_QUALITY), MJPEG_PART_FOOTER)
 
-        yield(b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + 
-              bytearray(encodedImage) + b'\r\n')
 
 # --- Flask Routes ---
 @app.route('/')
@@ -154,11 +236,11 @@ def get_gamestate():
     """API to get current game state and then reset the flash flag."""
     with state_lock:
         # Copy the state to send before modifying it
-        state_to_send = game_state.copy()
+        state_to_send = _current_state()
         # Reset the flash so it only fires once per event
         if game_state["penalty_flash"]:
             game_state["penalty_flash"] = False
-        return json.dumps(state_to_send)
+        return json_response(state_to_send)
 
 @app.route('/api/restart', methods=['POST'])
 def restart_game():
@@ -172,7 +254,9 @@ def restart_game():
             "penalty_flash": False,
             "last_penalty_time": 0,
         }
-    return json.dumps(game_state)
+        _reset_clock()
+        _schedule_transitions()
+    return json_response(game_state)
 
 @app.route('/api/start', methods=['POST'])
 def start_game():
@@ -186,22 +270,24 @@ def start_game():
             "penalty_flash": False,
             "last_penalty_time": 0,
         }
-    return json.dumps({"status": "game started", "state": game_state})
+        _reset_clock()
+        _schedule_transitions()
+    return json_response({"status": "game started", "state": game_state})
 
 @app.route('/api/end', methods=['POST'])
 def end_game():
     """API to end the game."""
     global game_state
     with state_lock:
+        _freeze_clock()
         game_state["mode"] = "GAME_OVER"
-    return json.dumps({"status": "game ended", "state": game_state})
+        _schedule_transitions()
+    return json_response({"status": "game ended", "state": game_state})
 
 # --- Main Execution ---
 if __name__ == '__main__':
-    # Start the game logic thread
-    logic_thread = threading.Thread(target=game_logic_thread)
-    logic_thread.daemon = True
-    logic_thread.start()
+    # Start the game logic timers
+    start_game_logic()
     
     # Run the Flask app
     app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
@@ -0,0 +1,64 @@
+"""Frame overlay, JPEG encoding and response helpers shared by app.py and ip_address.py."""
+import cv2
+import numpy as np
+import orjson
+import simplejpeg
+from flask import Response
+
+# Multipart framing around each JPEG. The parts are yielded as separate chunks so the
+# JPEG bytes are handed to the server as-is instead of being copied into a new string.
+MJPEG_PART_HEADER = b'--frame\r\nContent-Type: image/jpeg\r\n\r\n'
+MJPEG_PART_FOOTER = b'\r\n'
+
+# Rendered text sprites keyed by (text, scale, color, thickness): (colored patch, glyph mask, x offset, y offset)
+overlay_cache = {}
+
+
+def get_overlay(text, scale, color, thickness):
+    """
+    Renders the text once into a small patch + mask and caches it. Some glyphs (e.g. '|', 'j')
+    reach past the box reported by getTextSize, so the text is drawn with a generous margin and
+    the sprite is cropped to the pixels actually drawn. The offsets locate the sprite relative to org.
+    """
+    key = (text, scale, color, thickness)
+    overlay = overlay_cache.get(key)
+    if overlay is None:
+        (width, ascent), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, scale, thickness)
+        margin = ascent + baseline + thickness
+        canvas = np.zeros((ascent + baseline + 2 * margin, width + 2 * margin), np.uint8)
+        cv2.putText(canvas, text, (margin, margin + ascent), cv2.FONT_HERSHEY_SIMPLEX, scale, 255, thickness, cv2.LINE_8)
+        x, y, w, h = cv2.boundingRect(canvas)
+        mask = canvas[y:y + h, x:x + w].copy()
+        patch = np.empty(mask.shape + (3,), np.uint8)
+        patch[:] = color
+        overlay = (patch, mask, x - margin, y - margin - ascent)
+        overlay_cache[key] = overlay
+    return overlay
+
+
+def draw_text(frame, text, org, scale, color, thickness):
+    """
+    Same output as cv2.putText with OpenCV 4.x's default LINE_8 (requirements.txt pins opencv-python<5,
+    whose putText antialiases by default), but copies a cached rendering instead of drawing the glyphs.
+    """
+    patch, mask, dx, dy = get_overlay(text, scale, color, thickness)
+    if mask.size == 0:
+        return
+    x0 = org[0] + dx
+    y0 = org[1] + dy
+    roi = frame[max(y0, 0):y0 + mask.shape[0], max(x0, 0):x0 + mask.shape[1]]
+    if x0 < 0 or y0 < 0 or roi.shape[:2] != mask.shape:
+        # Text clipped by the frame border: fall back to drawing it
+        cv2.putText(frame, text, org, cv2.FONT_HERSHEY_SIMPLEX, scale, color, thickness, cv2.LINE_8)
+        return
+    cv2.copyTo(patch, mask, roi)
+
+
+def encode_jpeg(frame, quality):
+    """Encode a BGR frame with libjpeg-turbo (simplejpeg), which is faster than cv2.imencode."""
+    return simplejpeg.encode_jpeg(frame, quality=quality, colorspace='BGR', fastdct=True)
+
+
+def json_response(data, status=200):
+    """Serialises data with orjson (returns bytes, no extra encode) into a JSON response."""
+    return Response(orjson.dumps(data), status=status, mimetype='application/json')